@@ -1,107 +1,186 @@
 from dataclasses import dataclass
-from enum import Enum, auto
-from re import findall
-from sys import argv
-from typing import Callable
+from enum import IntEnum
+from functools import lru_cache
+import operator
+import re
+from sys import argv, intern, stdin
+from typing import Callable, Sequence
 
 
-Token = tuple[str, str, str]
+# Has three capture groups: the first represents the word type,
+# the second and third are mutually exclusive and represent the string value.
+# Newlines are excluded everywhere so that no token can span multiple lines.
+# Quoted strings are matched as "unescaped run, then (escape, unescaped run)*" so that the engine
+# never has to backtrack through nested quantifiers.
+TOKEN_REGEX: re.Pattern[str] = re.compile(r'([:$]?)(?:([^ \t\r\n"]+)|"([^"\\\n]*(?:\\.[^"\\\n]*)*)")')
 
+# Turns every other whitespace character that separates words into a space.
+# Without quotes, words are just runs of non-whitespace, so such sources can be split on spaces instead.
+DELIMITER_TABLE: dict[int, str] = str.maketrans("\t\r\n", "   ")
 
-class WordType(Enum):
-    STRING = auto()  # foo
-    DEFINE = auto()  # :bar
-    CALL = auto()  # $baz
 
+class WordType(IntEnum):
+    STRING = 0  # foo
+    DEFINE = 1  # :bar
+    CALL = 2  # $baz
+    PUSH_CALL = 3  # foo $qux, where qux is a builtin; only created by 'fuseWords()'.
 
-@dataclass
+
+# Looking up members on an Enum class is slow, so hot loops compare against these instead.
+STRING: WordType = WordType.STRING
+DEFINE: WordType = WordType.DEFINE
+CALL: WordType = WordType.CALL
+PUSH_CALL: WordType = WordType.PUSH_CALL
+
+
+@dataclass(slots=True)
 class Word:
     type: WordType
     value: str
+    # Builtins cannot be redefined, so calls to them are resolved once when parsing.
+    target: Callable[["Stack"], None] | None = None
+
+
+# Maps the prefix captured by TOKEN_REGEX to the type of the word.
+WORD_TYPES: dict[str, WordType] = {"": WordType.STRING, ":": WordType.DEFINE, "$": WordType.CALL}
 
 
 class Stack:
 
     value: list[str]
+    # Bound directly to 'value.append' so that pushing doesn't go through an extra Python call.
+    push: Callable[[str], None]
 
     def __init__(self):
         self.value = []
-
-    def push(self, item: str):
-        self.value.append(item)
+        self.push = self.value.append
 
     def pop(self) -> str:
-        if len(self.value) <= 0:
-            return ""
-        else:
+        if self.value:
             return self.value.pop()
+        else:
+            return ""
 
 
 # These are for builtin words, e.g., drop, swap, etc.
 builtins: dict[str, Callable[[Stack], None]] = {}
 # These are for user-defined words.
-dictionary: dict[str, list[Word]] = {}
+dictionary: dict[str, Sequence[Word]] = {}
 
 
-def lexLines(lines: list[str]) -> list[Token]:
-    result: list[Token] = []
-    for line in lines:
-        # Has three capture groups: the first represents the word type,
-        # the second and third are mutually exclusive and represent the string value.
-        tokens: list[Token] = findall(r'([:$]?)(?:([^ \t\r"]+)|"((?:[^"\\]*(?:\\.)?)*)")', line)
-        for token in tokens:
-            result.append(token)
+def lexParseUnquoted(source: str) -> list[Word]:
+    result: list[Word] = []
+    for token in source.translate(DELIMITER_TABLE).split(" "):
+        if token == "":
+            continue
+        # A lone ':' or '$' is a string, just like TOKEN_REGEX treats it.
+        wordType: WordType = WORD_TYPES.get(token[0], STRING) if len(token) > 1 else STRING
+        if wordType == STRING:
+            result.append(Word(wordType, token))
+        else:
+            # Names are interned so that the dictionary lookups can compare them by identity.
+            value: str = intern(token[1:])
+            result.append(Word(wordType, value, builtins.get(value) if wordType == CALL else None))
     return result
 
 
-def lexString(string: str) -> list[Token]:
-    return lexLines(string.split("\n"))
+def lexParse(source: str) -> list[Word]:
+    if '"' not in source:
+        return lexParseUnquoted(source)
 
-
-def parseTokens(tokens: list[Token]) -> list[Word]:
     result: list[Word] = []
-    for token in tokens:
-        wordType, shortString, longString = token
+    # Matches are consumed one at a time rather than collected with 'findall()' first,
+    # so a large source never needs a whole list of token tuples in memory.
+    for match in TOKEN_REGEX.finditer(source):
         value: str
-        if shortString == "":
-            # Uses Python's escape sequence parser.
-            value = bytes(longString, "utf-8").decode("unicode_escape")
+        if match.lastindex == 2:
+            value = match[2]
+        else:
+            longString: str = match[3]
+            if "\\" not in longString and longString.isascii():
+                # Nothing for the escape sequence parser to change.
+                value = longString
+            else:
+                # Uses Python's escape sequence parser.
+                value = bytes(longString, "utf-8").decode("unicode_escape")
+        wordType: WordType = WORD_TYPES[match[1]]
+        if wordType == STRING:
+            result.append(Word(wordType, value))
         else:
-            value = shortString
-
-        match wordType:
-            case "":
-                result.append(Word(WordType.STRING, value))
-            case ":":
-                result.append(Word(WordType.DEFINE, value))
-            case "$":
-                result.append(Word(WordType.CALL, value))
-            case _:
-                # This should be unreachable.
-                raise NotImplementedError("Invalid WordType.")
+            # Names are interned so that the dictionary lookups can compare them by identity.
+            value = intern(value)
+            result.append(Word(wordType, value, builtins.get(value) if wordType == CALL else None))
+    return result
 
+
+# Fuses every string followed by a call to a builtin (e.g. '1 $+') into a single word,
+# so that evaluating the pair takes one trip through the loop in 'evaluateWords()' instead of two.
+def fuseWords(words: list[Word]) -> list[Word]:
+    result: list[Word] = []
+    for word in words:
+        if word.target is not None and len(result) > 0 and result[-1].type == STRING:
+            result[-1] = Word(PUSH_CALL, result[-1].value, word.target)
+        else:
+            result.append(word)
     return result
 
 
-def evaluateWords(words: list[Word], stack: Stack):
-    while len(words) > 0:
-        word: Word = words[0]
-        words = words[1:]
-        match word.type:
-            case WordType.STRING:
-                stack.push(word.value)
-            case WordType.DEFINE:
-                dictionary[word.value] = parseTokens(lexString(stack.pop()))
-            case WordType.CALL:
-                if word.value in builtins:
-                    builtins[word.value](stack)
-                elif word.value in dictionary:
-                    words = dictionary[word.value] + words
-                else:
-                    pass  # Undefined words do nothing when called.
+# Strings tend to be evaluated over and over (e.g. the body of a recursive word),
+# so their parsed form is cached. Tuples are used as the cached words are shared.
+@lru_cache(maxsize=1024)
+def compileSource(source: str) -> tuple[Word, ...]:
+    return tuple(fuseWords(lexParse(source)))
 
 
-def main():
+def evaluateWords(words: Sequence[Word], stack: Stack):
+    # This loop runs once per evaluated word, so methods used in it are looked up only once.
+    push: Callable[[str], None] = stack.push
+    lookup: Callable[[str], Sequence[Word] | None] = dictionary.get
+    # Words still to be evaluated by unfinished calls, as (words, index of the next word) pairs.
+    frames: list[tuple[Sequence[Word], int]] = []
+    index: int = 0
+    length: int = len(words)
+    while True:
+        if index >= length:
+            if len(frames) <= 0:
+                break
+            words, index = frames.pop()
+            length = len(words)
+            continue
+
+        word: Word = words[index]
+        index += 1
+        # Ordered from the most to the least frequent word type.
+        wordType: WordType = word.type
+        if wordType == STRING:
+            push(word.value)
+        elif wordType == PUSH_CALL:
+            push(word.value)
+            word.target(stack)
+        elif wordType == CALL:
+            target: Callable[[Stack], None] | None = word.target
+            if target is not None:
+                target(stack)
+            else:
+                definition: Sequence[Word] | None = lookup(word.value)
+                if definition is None:
+                    continue  # Undefined words do nothing when called.
+                # Calls in tail position simply replace the current words.
+                if index < length:
+                    frames.append((words, index))
+                words = definition
+                index = 0
+                length = len(words)
+        else:
+            dictionary[word.value] = compileSource(stack.pop())
+
+
+def readSource() -> str:
+    # Piped programs are read in one go, which is much faster than line by line.
+    if not stdin.isatty():
+        return stdin.read()
+
+    # Programs typed into a terminal go through 'input()' to keep its line editing.
     # Read every line until EOF.
     lines: list[str] = []
     while True:
@@ -110,6 +189,11 @@ def main():
         except EOFError:
             break
         lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    source: str = readSource()
 
     # Use argv contents as the initial stack.
     stack: Stack = Stack()
@@ -117,7 +201,7 @@ def main():
         stack.push(argument)
 
     try:
-        evaluateWords(parseTokens(lexLines(lines)), stack)
+        evaluateWords(fuseWords(lexParse(source)), stack)
     except RecursionError:
         # Is it really an error if a program is valid while taking infinite time to complete...?
         print("Recursion Limit :(")
@@ -139,9 +223,12 @@ def addBuiltin(name: str):
 
 def createRotBuiltin(n: int):
     def builtinRot(stack: Stack):
-        values: list[str] = [stack.pop() for _ in range(n)]
-        values = [values[-1]] + values[:-1]
-        [stack.push(item) for item in values[::-1]]
+        values: list[str] = stack.value
+        # Missing items are treated as empty strings, just like 'Stack.pop()' does.
+        if len(values) < n:
+            values[:0] = [""] * (n - len(values))
+        # Moves the n-th item from the top to the top.
+        values[-n:] = values[1 - n :] + [values[-n]]
 
     return builtinRot
 
@@ -173,6 +260,22 @@ def createBinaryOpBuiltin(func: Callable[[str, str], str]):
     return builtinBinaryOp
 
 
+# Same as 'createBinaryOpBuiltin(lambda a, b: str(func(str2num(a), str2num(b))))', just
+# without the extra call through a lambda on every arithmetic operation.
+def createNumericOpBuiltin(func: Callable[[int | float, int | float], object]):
+    def builtinNumericOp(stack: Stack):
+        a: str = stack.pop()
+        b: str = stack.pop()
+        result: str
+        try:
+            result = str(func(str2num(b), str2num(a)))
+        except:
+            result = "Undefined"
+        stack.push(result)
+
+    return builtinNumericOp
+
+
 def createTrinaryOpBuiltin(func: Callable[[str, str, str], str]):
     def builtinTrinaryOp(stack: Stack):
         a: str = stack.pop()
@@ -206,10 +309,14 @@ def str2int(string: str) -> int:
 # Use this for arithmetic operations so that operations with ints result in an int.
 def str2num(string: str) -> int | float:
     result: int | float
-    try:
-        result = int(string)
-    except:
+    if "." in string:
+        # 'int()' would reject it anyway, so go straight to 'float()' instead of raising.
         result = float(string)
+    else:
+        try:
+            result = int(string)
+        except:
+            result = float(string)
     return result
 
 
@@ -240,24 +347,24 @@ def builtinSwap(stack: Stack):
 for i in range(3, 10):
     addBuiltin(f"rot{i}")(createRotBuiltin(i))
 
-addBuiltin("+")(createBinaryOpBuiltin(lambda a, b: str(str2num(a) + str2num(b))))
-addBuiltin("-")(createBinaryOpBuiltin(lambda a, b: str(str2num(a) - str2num(b))))
-addBuiltin("*")(createBinaryOpBuiltin(lambda a, b: str(str2num(a) * str2num(b))))
-addBuiltin("/")(createBinaryOpBuiltin(lambda a, b: str(str2num(a) / str2num(b))))
+addBuiltin("+")(createNumericOpBuiltin(operator.add))
+addBuiltin("-")(createNumericOpBuiltin(operator.sub))
+addBuiltin("*")(createNumericOpBuiltin(operator.mul))
+addBuiltin("/")(createNumericOpBuiltin(operator.truediv))
 addBuiltin("~")(createUnaryOpBuiltin(lambda x: str(-str2num(x))))
 
-# Use 'all()' and 'any()' instead of 'and' and 'or' to prevent short-circuit behaviour.
-addBuiltin("and")(createBinaryOpBuiltin(lambda a, b: str(all([str2bool(a), str2bool(b)]))))
-addBuiltin("or")(createBinaryOpBuiltin(lambda a, b: str(any([str2bool(a), str2bool(b)]))))
+# Use '&' and '|' instead of 'and' and 'or' to prevent short-circuit behaviour.
+addBuiltin("and")(createBinaryOpBuiltin(lambda a, b: str(str2bool(a) & str2bool(b))))
+addBuiltin("or")(createBinaryOpBuiltin(lambda a, b: str(str2bool(a) | str2bool(b))))
 addBuiltin("not")(createUnaryOpBuiltin(lambda x: str(not str2bool(x))))
 
 addBuiltin("==")(createBinaryOpBuiltin(lambda a, b: str(a == b)))
 addBuiltin("!=")(createBinaryOpBuiltin(lambda a, b: str(a != b)))
 
-addBuiltin("<")(createBinaryOpBuiltin(lambda a, b: str(str2num(a) < str2num(b))))
-addBuiltin(">")(createBinaryOpBuiltin(lambda a, b: str(str2num(a) > str2num(b))))
-addBuiltin("<=")(createBinaryOpBuiltin(lambda a, b: str(str2num(a) <= str2num(b))))
-addBuiltin(">=")(createBinaryOpBuiltin(lambda a, b: str(str2num(a) >= str2num(b))))
+addBuiltin("<")(createNumericOpBuiltin(operator.lt))
+addBuiltin(">")(createNumericOpBuiltin(operator.gt))
+addBuiltin("<=")(createNumericOpBuiltin(operator.le))
+addBuiltin(">=")(createNumericOpBuiltin(operator.ge))
 
 addBuiltin("if")(
     createTrinaryOpBuiltin(
@@ -266,7 +373,6 @@ addBuiltin("if")(
 )
 
 addBuiltin("len")(createUnaryOpBuiltin(lambda x: str(len(x))))
-addBuiltin("cat")(createBinaryOpBuiltin(lambda a, b: a + b))
 addBuiltin("substr")(createTrinaryOpBuiltin(lambda string, start, end: string[str2int(start) : str2int(end)]))
 addBuiltin("replace")(createTrinaryOpBuiltin(lambda string, old, new: string.replace(old, new)))
 
@@ -274,10 +380,20 @@ addBuiltin("int")(createUnaryOpBuiltin(lambda x: str(str2int(x))))
 addBuiltin("float")(createUnaryOpBuiltin(lambda x: str(float(x))))
 
 
+# Not created with 'createBinaryOpBuiltin()' so that CPython can append to 'b' in place when nothing else
+# refers to it, which keeps building up a string with repeated cats from taking quadratic time.
+@addBuiltin("cat")
+def builtinCat(stack: Stack):
+    a: str = stack.pop()
+    b: str = stack.pop()
+    b += a
+    stack.push(b)
+
+
 @addBuiltin("eval")
 def builtinEval(stack: Stack):
     item: str = stack.pop()
-    evaluateWords(parseTokens(lexString(item)), stack)
+    evaluateWords(compileSource(item), stack)
 
 
 ### End of Builtin Words ###